@@ -1,18 +1,21 @@
 import torch
+import torch.distributed as dist
 from torchvision.datasets import ImageFolder
 import torchvision.transforms as transforms
 
 class Dataloader:
-    def __init__(self, dataset_dir, batch_sizes, max_tick, n_cpu):
+    def __init__(self, dataset_dir, batch_sizes, max_tick, n_cpu, distributed=False):
         self.dataset_dir = dataset_dir
         self.batch_sizes = batch_sizes
         self.img_size = 4
         self.max_tick = max_tick
         self.checkpoint = 0
         self.n_cpu = n_cpu
+        self.distributed = distributed
+        self.world_size = dist.get_world_size() if distributed else 1
 
     def __iter__(self):
-        return DataIter(self.dataset, self.batch_size, self.max_tick, self.checkpoint, self.n_cpu)
+        return DataIter(self.dataset, self.batch_size, self.max_tick, self.checkpoint, self.n_cpu, self.distributed)
     
     def set_checkpoint(self, checkpoint_tick):
         self.checkpoint = checkpoint_tick
@@ -30,13 +33,20 @@ class Dataloader:
         ]))
 
     def __len__(self):
-        return (self.max_tick - self.checkpoint) // self.batch_size
+        return (self.max_tick - self.checkpoint) // (self.batch_size * self.world_size)
 
 class DataIter:
-    def __init__(self, dataset, batch_size, max_tick, checkpoint, n_cpu):
+    def __init__(self, dataset, batch_size, max_tick, checkpoint, n_cpu, distributed=False):
+        # each process gets its own shard, ticks count images over all processes
+        self.sampler = torch.utils.data.DistributedSampler(dataset, drop_last=True) if distributed else None
+        self.world_size = dist.get_world_size() if distributed else 1
+        self.epoch = 0
+        # keep workers alive across epochs and a few batches ahead of the trainer
+        workers_kwargs = dict(persistent_workers=True, prefetch_factor=4) if n_cpu > 0 else {}
         self.dataloader = torch.utils.data.DataLoader(
             dataset, batch_size=batch_size, pin_memory=True,
-            shuffle=True, drop_last=True, num_workers=n_cpu,
+            shuffle=self.sampler is None, sampler=self.sampler, drop_last=True, num_workers=n_cpu,
+            **workers_kwargs
         )
         self.iter = iter(self.dataloader)
         self.tick = self.checkpoint = checkpoint
@@ -50,12 +60,15 @@ class DataIter:
         try:
             data = next(self.iter)
         except StopIteration as e:
+            if self.sampler is not None:
+                self.epoch += 1
+                self.sampler.set_epoch(self.epoch)
             self.iter = iter(self.dataloader)
             data = next(self.iter)
         
-        self.tick += self.batch_size
+        self.tick += self.batch_size * self.world_size
         
         return data, self.tick
 
     def __len__(self):
-        return (self.max_tick - self.checkpoint) // self.batch_size
\ No newline at end of file
+        return (self.max_tick - self.checkpoint) // (self.batch_size * self.world_size)
\ No newline at end of file
@@ -36,7 +36,9 @@ class Inferencer:
         self.generator.cuda()
   
     def load_checkpoint(self, img_size, filename):
-        checkpoint = torch.load(filename)
+        # map tensors straight onto the current gpu instead of unpickling to host memory first
+        checkpoint = torch.load(filename, map_location='cuda:{}'.format(torch.cuda.current_device()),
+                                mmap=True, weights_only=True)
 
         print('load {}x{} checkpoint'.format(checkpoint['img_size'], checkpoint['img_size']))
         while img_size < checkpoint['img_size']:
@@ -1,3 +1,5 @@
+import os
+
 import fire
 
 from config import Config
@@ -7,9 +9,22 @@ def main(config_file, run_type='train', checkpoint=''):
     # pylint: disable=no-member
     config = Config(config_file)
 
-    print(config)
+    # torchrun sets RANK, only the first process prints
+    if int(os.environ.get('RANK', 0)) == 0:
+        print(config)
 
     if run_type == 'train':
+        # launched with torchrun: one process per GPU
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        if 'WORLD_SIZE' in os.environ:
+            import torch
+            import torch.distributed as dist
+            torch.cuda.set_device(local_rank)
+            dist.init_process_group('nccl')
+            # every process starts from the same default seed, so latents and noise maps would be
+            # identical across ranks. weights are broadcast from rank 0 when DDP wraps the models
+            torch.manual_seed(torch.initial_seed() + dist.get_rank())
+
         from trainer import Trainer
         trainer = Trainer(
             dataset_dir=config.dataset_dir,
@@ -24,7 +39,8 @@ def main(config_file, run_type='train', checkpoint=''):
             weights_halflife=config.weights_halflife_images,
             batch_size=config.batch_size,
             n_cpu=config.n_cpu,
-            opt_level=config.opt_level
+            opt_level=config.opt_level,
+            local_rank=local_rank
         )
         trainer.run(
             log_iter=config.log_iter,
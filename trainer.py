@@ -1,20 +1,22 @@
-import copy
+import contextlib
 import random
 
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.autograd import grad
+from torch.cuda.amp import autocast, GradScaler
+from torch.nn.parallel import DistributedDataParallel as DDP
 from tqdm import tqdm
 
-import amp_support as amp
 import tf_recorder as tensorboard
 from dataloader import Dataloader
 from networks import Generator, Discriminator
 
 
-def requires_grad(model, flag=True):
-    for p in model.parameters():
+def requires_grad(params, flag=True):
+    for p in params:
         p.requires_grad = flag
 
 
@@ -23,20 +25,27 @@ class EMA():
     def __init__(self):
         self.mu = None
         self.shadow = {}
+        # flat lists rebuilt on every grow, so one step is a single fused lerp
+        self.params = []
+        self.shadow_params = []
 
     def register(self, name, val):
-        self.shadow[name] = val.clone()
+        self.shadow[name] = val.detach().clone()
 
-    def __call__(self, name, x):
-        assert name in self.shadow
-        new_average = (1.0 - self.mu) * x + self.mu * self.shadow[name]
-        self.shadow[name] = new_average.clone()
-        return new_average
+    @torch.no_grad()
+    def __call__(self):
+        # shadow = mu * shadow + (1 - mu) * param
+        # live parameters are not contiguous, so a flat parameters_to_vector shadow would need a full
+        # cat of the generator every step; the multi-tensor lerp reads each parameter once instead
+        torch._foreach_lerp_(self.shadow_params, self.params, 1.0 - self.mu)
 
     def set_weights(self, ema_model):
+        params, shadow = [], []
         for name, param in ema_model.named_parameters():
             if param.requires_grad:
-                param.data = self.shadow[name]
+                params.append(param.data)
+                shadow.append(self.shadow[name])
+        torch._foreach_copy_(params, shadow)
 
     def grow(self, model_grown, new_mu):
         self.mu = new_mu
@@ -49,104 +58,128 @@ class EMA():
             else:
                 new_shadow[name] = self.shadow[name]
         self.shadow = new_shadow
+        self.params, self.shadow_params = [], []
         for name, param in model_grown.named_parameters():
-            if param.requires_grad and name not in self.shadow:
-                self.shadow[name] = param.clone()
+            if param.requires_grad:
+                if name not in self.shadow:
+                    self.shadow[name] = param.detach().clone()
+                self.params.append(param)
+                self.shadow_params.append(self.shadow[name])
 
 
 class Trainer:
     def __init__(self, dataset_dir, generator_channels, discriminator_channels, nz, style_depth, lrs, betas, eps,
-                 phase_iter, weights_halflife, batch_size, n_cpu, opt_level):
+                 phase_iter, weights_halflife, batch_size, n_cpu, opt_level, local_rank=0):
         self.nz = nz
-        self.dataloader = Dataloader(dataset_dir, batch_size, phase_iter * 2, n_cpu)
-
-        self.generator = Generator(generator_channels, nz, style_depth).cuda()
-        self.generator_ema = Generator(generator_channels, nz, style_depth).cuda()
-        self.generator_ema.load_state_dict(copy.deepcopy(self.generator.state_dict()))
-        self.discriminator = Discriminator(discriminator_channels).cuda()
+        self.local_rank = local_rank
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        # only the first process logs and writes checkpoints
+        self.is_main = not self.distributed or dist.get_rank() == 0
+        self.dataloader = Dataloader(dataset_dir, batch_size, phase_iter * 2, n_cpu, self.distributed)
+
+        self.generator = Generator(generator_channels, nz, style_depth).cuda().to(memory_format=torch.channels_last)
+        self.generator_ema = Generator(generator_channels, nz, style_depth).cuda().to(memory_format=torch.channels_last)
+        with torch.no_grad():
+            for p_ema, p in zip(self.generator_ema.parameters(), self.generator.parameters()):
+                p_ema.copy_(p)
+            for b_ema, b in zip(self.generator_ema.buffers(), self.generator.buffers()):
+                b_ema.copy_(b)
+        self.discriminator = Discriminator(discriminator_channels).cuda().to(memory_format=torch.channels_last)
 
-        self.tb = tensorboard.tf_recorder('StyleGAN')
+        self.tb = tensorboard.tf_recorder('StyleGAN') if self.is_main else None
 
         self.phase_iter = phase_iter
         self.lrs = lrs
         self.betas = betas
         self.weights_halflife = weights_halflife
 
-        self.opt_level = opt_level
+        # apex-style opt levels are kept in the config; anything above O0 enables native mixed precision
+        self.use_amp = opt_level != 'O0'
+        self.scaler_g = GradScaler(enabled=self.use_amp)
+        self.scaler_d = GradScaler(enabled=self.use_amp)
 
         self.ema = None
+        self.z = None
 
-        torch.backends.cuda.benchmark = True
-
-    def generator_trainloop(self, batch_size, alpha):
-        requires_grad(self.generator, True)
-        requires_grad(self.discriminator, False)
+        torch.backends.cudnn.benchmark = True
 
+    def sample_z(self, batch_size):
+        # latents are drawn into a persistent buffer, reallocated only when the batch size changes in grow()
         # mixing regularization
         if random.random() < 0.9:
-            z = [torch.randn(batch_size, self.nz).cuda(),
-                 torch.randn(batch_size, self.nz).cuda()]
+            # both styles come from a single rng launch
+            self.z.normal_()
+            return [self.z[0, :batch_size], self.z[1, :batch_size]]
         else:
-            z = torch.randn(batch_size, self.nz).cuda()
-
-        fake = self.generator(z, alpha=alpha)
-        d_fake = self.discriminator(fake, alpha=alpha)
-        loss = F.softplus(-d_fake).mean()
+            self.z[0].normal_()
+            return self.z[0, :batch_size]
 
-        self.optimizer_g.zero_grad()
-        with amp.scale_loss(loss, self.optimizer_g) as scaled_loss:
-            scaled_loss.backward()
-        self.optimizer_g.step()
-        for name, param in self.generator.named_parameters():
-            if param.requires_grad:
-                self.ema(name, param.data)
-
-        return loss.item()
-
-    def discriminator_trainloop(self, real, alpha):
-        requires_grad(self.generator, False)
-        requires_grad(self.discriminator, True)
+    def generator_trainloop(self, batch_size, alpha):
+        requires_grad(self.discriminator_params, False)
 
-        real.requires_grad = True
-        self.optimizer_d.zero_grad()
-
-        d_real = self.discriminator(real, alpha=alpha)
-        loss_real = F.softplus(-d_real).mean()
-        with amp.scale_loss(loss_real, self.optimizer_d) as scaled_loss_real:
-            scaled_loss_real.backward(retain_graph=True)
-
-        grad_real = grad(
-            outputs=d_real.sum(), inputs=real, create_graph=True
-        )[0]
-        grad_penalty = (
-                grad_real.view(grad_real.size(0), -1).norm(2, dim=1) ** 2
-        ).mean()
-        grad_penalty = 10 / 2 * grad_penalty
-        with amp.scale_loss(grad_penalty, self.optimizer_d) as scaled_grad_penalty:
-            scaled_grad_penalty.backward()
+        z = self.sample_z(batch_size)
 
-        if random.random() < 0.9:
-            z = [torch.randn(real.size(0), self.nz).cuda(),
-                 torch.randn(real.size(0), self.nz).cuda()]
-        else:
-            z = torch.randn(real.size(0), self.nz).cuda()
+        with autocast(enabled=self.use_amp):
+            fake = self.generator_train(z, alpha=alpha)
+            d_fake = self.discriminator(fake, alpha=alpha)
+            loss = F.softplus(-d_fake).mean()
 
-        fake = self.generator(z, alpha=alpha)
-        d_fake = self.discriminator(fake, alpha=alpha)
-        loss_fake = F.softplus(d_fake).mean()
-        with amp.scale_loss(loss_fake, self.optimizer_d) as scaled_loss_fake:
-            scaled_loss_fake.backward()
+        self.optimizer_g.zero_grad(set_to_none=True)
+        self.scaler_g.scale(loss).backward()
+        self.scaler_g.step(self.optimizer_g)
+        self.scaler_g.update()
+        self.ema()
 
-        loss = scaled_loss_real + scaled_loss_fake + scaled_grad_penalty
+        return loss.detach()
 
-        self.optimizer_d.step()
+    def discriminator_trainloop(self, real, alpha):
+        requires_grad(self.discriminator_params, True)
 
-        return loss.item(), (d_real.mean().item(), d_fake.mean().item())
+        real.requires_grad = True
+        self.optimizer_d.zero_grad(set_to_none=True)
+
+        # real gradients are accumulated locally and all-reduced with the fake ones
+        no_sync = self.discriminator_train.no_sync() if self.distributed else contextlib.nullcontext()
+        with no_sync:
+            with autocast(enabled=self.use_amp):
+                d_real = self.discriminator_train(real, alpha=alpha)
+                loss_real = F.softplus(-d_real).mean()
+
+            # R1 penalty is computed in fp32 on unscaled gradients, then backpropagated
+            # together with the real loss so the real graph is traversed only once
+            # sum in fp32, a scaled fp16 sum would overflow at the initial 2 ** 16 scale
+            scaled_grad_real = grad(
+                outputs=self.scaler_d.scale(d_real.float().sum()), inputs=real, create_graph=True
+            )[0]
+            # get_scale() would sync with the host, scaling a one keeps the factor on the device
+            grad_real = scaled_grad_real / self.scaler_d.scale(real.new_ones(()))
+            # squared l2 norm per sample as one sum of squares, gamma / 2 = 10 / 2 folded in
+            grad_penalty = 5.0 * grad_real.pow(2).flatten(1).sum(1).mean()
+            self.scaler_d.scale(loss_real + grad_penalty).backward()
+
+        z = self.sample_z(real.size(0))
+
+        with autocast(enabled=self.use_amp):
+            # no generator graph is needed for the discriminator update
+            with torch.no_grad():
+                fake = self.generator(z, alpha=alpha)
+            d_fake = self.discriminator_train(fake, alpha=alpha)
+            loss_fake = F.softplus(d_fake).mean()
+        self.scaler_d.scale(loss_fake).backward()
+
+        loss = loss_real + loss_fake + grad_penalty
+
+        self.scaler_d.step(self.optimizer_d)
+        self.scaler_d.update()
+
+        # stay on the device; run() only syncs with the host on logging iterations
+        return loss.detach(), (d_real.detach().float().mean(), d_fake.detach().float().mean())
 
     def run(self, log_iter, checkpoint):
         global_iter = 0
 
-        test_z = torch.randn(4, self.nz).cuda()
+        test_z = torch.randn(4, self.nz, device='cuda')
 
         self.ema = self.init_ema()
         if checkpoint:
@@ -155,28 +188,38 @@ class Trainer:
             self.grow()
 
         while True:
-            print('train {}X{} images...'.format(self.dataloader.img_size, self.dataloader.img_size))
+            if self.is_main:
+                print('train {}X{} images...'.format(self.dataloader.img_size, self.dataloader.img_size))
 
-            for iter, ((data, _), n_trained_samples) in enumerate(tqdm(self.dataloader), 1):
-                real = data.cuda()
+            for iter, ((data, _), n_trained_samples) in enumerate(tqdm(self.dataloader, disable=not self.is_main), 1):
+                real = data.cuda(non_blocking=True, memory_format=torch.channels_last)
                 alpha = min(1, n_trained_samples / self.phase_iter) if self.dataloader.img_size > 8 else 1
 
                 loss_d, (real_score, fake_score) = self.discriminator_trainloop(real, alpha)
                 loss_g = self.generator_trainloop(real.size(0), alpha)
 
                 if global_iter % log_iter == 0:
-                    self.save_ema()
-                    self.log(loss_d, loss_g, real_score, fake_score, test_z, alpha)
+                    # one device to host copy for all scalars
+                    scalars = torch.stack([loss_d, loss_g, real_score, fake_score])
+                    if self.distributed:
+                        dist.all_reduce(scalars)
+                        scalars /= self.world_size
+                    loss_d, loss_g, real_score, fake_score = scalars.tolist()
+                    if self.is_main:
+                        self.save_ema()
+                        self.log(loss_d, loss_g, real_score, fake_score, test_z, alpha)
 
                 # save 3 times during training
-                if iter % (len(self.dataloader) // 4 + 1) == 0:
+                if iter % (len(self.dataloader) // 4 + 1) == 0 and self.is_main:
                     self.save_ema()
                     self.save_checkpoint(n_trained_samples)
 
                 global_iter += 1
-                self.tb.iter(data.size(0))
-            self.save_ema()
-            self.save_checkpoint()
+                if self.is_main:
+                    self.tb.iter(data.size(0) * self.world_size)
+            if self.is_main:
+                self.save_ema()
+                self.save_checkpoint()
             self.grow()
 
     def save_ema(self):
@@ -196,13 +239,9 @@ class Trainer:
             fake = (fake + 1) * 0.5
             fake = torch.clamp(fake, min=0.0, max=1.0)
 
-            self.generator.cpu()
-            self.generator_ema.cuda()
             fake_ema = self.generator_ema(test_z, alpha=alpha)
             fake_ema = (fake_ema + 1) * 0.5
             fake_ema = torch.clamp(fake_ema, min=0.0, max=1.0)
-            self.generator_ema.cpu()
-            self.generator.cuda()
 
         self.tb.add_scalar('loss_d', loss_d)
         self.tb.add_scalar('loss_g', loss_g)
@@ -217,16 +256,41 @@ class Trainer:
         self.generator_ema.grow()
         self.dataloader.grow()
 
-        self.generator.cuda()
-        self.discriminator.cuda()
+        # NHWC layout lets cudnn pick its tensor core kernels without transposing
+        self.generator.cuda().to(memory_format=torch.channels_last)
+        self.generator_ema.cuda().to(memory_format=torch.channels_last)
+        self.discriminator.cuda().to(memory_format=torch.channels_last)
+
+        # toggled twice per iteration, so walk the module tree only once per phase
+        self.discriminator_params = list(self.discriminator.parameters())
+        # grow runs right after a generator step froze the discriminator, and DDP only
+        # registers parameters that require grad when it is constructed
+        requires_grad(self.discriminator_params, True)
+
+        # wrap after every grow since the parameter set changes, this also broadcasts rank 0's weights.
+        # each wrapper is only used where its own gradients are computed, the other network stays unwrapped
+        if self.distributed:
+            self.generator_train = DDP(self.generator, device_ids=[self.local_rank],
+                                       broadcast_buffers=False, find_unused_parameters=True)
+            self.discriminator_train = DDP(self.discriminator, device_ids=[self.local_rank],
+                                           broadcast_buffers=False, find_unused_parameters=True)
+        else:
+            self.generator_train = self.generator
+            self.discriminator_train = self.discriminator
 
         decay = 0.0
         if self.weights_halflife > 0:
-            decay = 0.5 ** (float(self.dataloader.batch_size) / self.weights_halflife)
+            # every generator step sees the batch of all processes
+            decay = 0.5 ** (float(self.dataloader.batch_size * self.world_size) / self.weights_halflife)
 
         self.ema.grow(self.generator, decay)
 
-        self.tb.renew('{}x{}'.format(self.dataloader.img_size, self.dataloader.img_size))
+        z_shape = (2, self.dataloader.batch_size, self.nz)
+        if self.z is None or self.z.shape != z_shape:
+            self.z = torch.empty(z_shape, device='cuda')
+
+        if self.is_main:
+            self.tb.renew('{}x{}'.format(self.dataloader.img_size, self.dataloader.img_size))
 
         self.lr = self.lrs.get(str(self.dataloader.img_size), 0.001)
         self.style_lr = self.lr * 0.01
@@ -239,12 +303,6 @@ class Trainer:
             betas=self.betas
         )
 
-        [self.generator, self.discriminator], [self.optimizer_g, self.optimizer_d] = amp.initialize(
-            [self.generator, self.discriminator],
-            [self.optimizer_g, self.optimizer_d],
-            opt_level=self.opt_level
-        )
-
     def save_checkpoint(self, tick='last'):
         torch.save({
             'generator': self.generator.state_dict(),
@@ -257,9 +315,12 @@ class Trainer:
         }, 'checkpoints/{}x{}_{}.pth'.format(self.dataloader.img_size, self.dataloader.img_size, tick))
 
     def load_checkpoint(self, filename):
-        checkpoint = torch.load(filename)
+        # map tensors straight onto the current gpu instead of unpickling to host memory first
+        checkpoint = torch.load(filename, map_location='cuda:{}'.format(torch.cuda.current_device()),
+                                mmap=True, weights_only=True)
 
-        print('load {}x{} checkpoint'.format(checkpoint['img_size'], checkpoint['img_size']))
+        if self.is_main:
+            print('load {}x{} checkpoint'.format(checkpoint['img_size'], checkpoint['img_size']))
         while self.dataloader.img_size < checkpoint['img_size']:
             self.grow()
 
@@ -273,4 +334,5 @@ class Trainer:
             self.grow()
         else:
             self.dataloader.set_checkpoint(checkpoint['tick'])
-            self.tb.iter(checkpoint['tick'])
+            if self.is_main:
+                self.tb.iter(checkpoint['tick'])